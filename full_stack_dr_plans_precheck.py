@@ -7,50 +7,81 @@
 
 import argparse
 import logging
-import re
+import queue
+import string
 import sys
 import time
-from enum import Enum
+from collections import namedtuple
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Pattern
+from typing import Any, Dict
 
 import oci
 from oci.exceptions import ServiceError
 
 # === Constants === #
-DRPG_OCID_PATTERN = re.compile(r'^ocid1\.drprotectiongroup\.[^.]+\.[^.]+\.[^.]+$')
-TOPIC_OCID_PATTERN = re.compile(r'^ocid1\.onstopic\.[^.]+\.[^.]+\.[^.]+$')
-REGION_PATTERN = re.compile(r'^[a-z0-9]{2}-[a-z0-9]+-\d{1}$')
+DRPG_OCID_TYPE = 'drprotectiongroup'
+TOPIC_OCID_TYPE = 'onstopic'
+REGION_CHARS = frozenset(string.ascii_lowercase + string.digits)
 
-REGION_MAPPING = {
-    'iad': 'us-ashburn-1',
-    'phx': 'us-phoenix-1',
-}
+LOG_BUFFER_SIZE = 64 * 1024
+EXECUTION_MAX_WAIT_SECONDS = 1200
+EXECUTION_TERMINAL_STATES = frozenset({"SUCCEEDED", "FAILED", "CANCELED", "DELETED"})
+
+_SIGNER = None
+_SESSION = None
+_DR_CLIENTS: Dict[str, Any] = {}
+
+
+# === Types === #
+# Result of list_active_dr_plans; kind is "ACTIVE", "TRANSITIONAL" or "ERROR"
+PlansResult = namedtuple("PlansResult", ["kind", "value"])
 
 
-# === Enums === #
-class DrPlanType(Enum):
-    SWITCHOVER = "SWITCHOVER"
-    FAILOVER = "FAILOVER"
-    START_DRILL = "START_DRILL"
-    STOP_DRILL = "STOP_DRILL"
+# Precheck execution options keyed by raw DR plan type. Older SDKs lack the
+# drill models, so types whose class is missing are left out of the table.
+_OPTIONS_CLS_NAMES = {
+    "SWITCHOVER": "SwitchoverPrecheckExecutionOptionDetails",
+    "FAILOVER": "FailoverPrecheckExecutionOptionDetails",
+    "START_DRILL": "StartDrillPrecheckExecutionOptionDetails",
+    "STOP_DRILL": "StopDrillPrecheckExecutionOptionDetails",
+}
+_OPTIONS_CLS = {
+    plan_type: getattr(oci.disaster_recovery.models, name)
+    for plan_type, name in _OPTIONS_CLS_NAMES.items()
+    if getattr(oci.disaster_recovery.models, name, None) is not None
+}
+
+# The options carry no per-plan state, so one instance per type is shared by all plans
+_OPTIONS_SINGLETONS = {k: cls() for k, cls in _OPTIONS_CLS.items()}
 
 
 # === Logging Configuration === #
-class LevelFilter(logging.Filter):
-    def __init__(self, level):
-        super().__init__()
-        self.level = level
+# The log format uses none of these, so skip collecting them per record
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
 
-    def filter(self, record):
-        return record.levelno == self.level
+class BufferedFileHandler(logging.FileHandler):
+    # Records accumulate in a large write buffer; flushed explicitly, not per record
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=LOG_BUFFER_SIZE,
+                    encoding=self.encoding or "utf-8")
 
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
 
-def setup_logger(drpg_ocid: str, base_dir: Path):
+
+def setup_logger(drpg_ocid: str, base_dir: Path, timestamp: str):
     logs_dir = base_dir / "logs"
     logs_dir.mkdir(exist_ok=True)
 
-    timestamp = time.strftime("%Y%m%d%H%M%S")
     all_log = logs_dir / f"{drpg_ocid}.log"
     notification_log = logs_dir / f"{drpg_ocid}_{timestamp}_notification.log"
 
@@ -62,45 +93,120 @@ def setup_logger(drpg_ocid: str, base_dir: Path):
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
-    handlers = []
-
-    fh_all = logging.FileHandler(all_log)
+    fh_all = BufferedFileHandler(all_log)
     fh_all.setFormatter(formatter)
     fh_all.setLevel(logging.INFO)
-    handlers.append(fh_all)
 
-    fh_notification = logging.FileHandler(notification_log)
+    fh_notification = BufferedFileHandler(notification_log, delay=True)
     fh_notification.setFormatter(formatter)
     fh_notification.setLevel(logging.INFO)
-#    fh_notification.addFilter(LevelFilter(logging.INFO))
-    handlers.append(fh_notification)
+
+    # File writes happen on the listener thread, off the OCI request path
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, fh_all, fh_notification, respect_handler_level=True)
+    listener.start()
+
+    qh = QueueHandler(log_queue)
+    qh.setLevel(logging.INFO)
 
     ch = logging.StreamHandler()
     ch.setFormatter(formatter)
     ch.setLevel(logging.INFO)
-    handlers.append(ch)
 
     for h in logger.handlers[:]:
         logger.removeHandler(h)
-    for h in handlers:
+    for h in (qh, ch):
         logger.addHandler(h)
 
-    return logger, notification_log
+    return logger, notification_log, listener
+
+
+def flush_log_files(listener):
+    # Block until the listener has handled every queued record, then push it to disk
+    listener.queue.join()
+    for h in listener.handlers:
+        h.flush()
 
 # === Utility Functions === #
-def is_valid_ocid(ocid: str, pattern: Pattern) -> bool:
-    return bool(pattern.match(ocid))
+def is_valid_ocid(ocid: str, resource_type: str) -> bool:
+    # ocid1.<resource_type>.<realm>.<region>.<unique_id>, no empty segments
+    parts = ocid.split('.')
+    return len(parts) == 5 and parts[0] == 'ocid1' and parts[1] == resource_type and all(parts)
+
+def is_region_name(region: str) -> bool:
+    # e.g. us-ashburn-1: two-char prefix, a name, a single trailing digit
+    parts = region.split('-')
+    return (
+        len(parts) == 3
+        and len(parts[0]) == 2
+        and len(parts[1]) > 0
+        and len(parts[2]) == 1
+        and parts[2] in string.digits
+        and REGION_CHARS.issuperset(parts[0] + parts[1])
+    )
+
+def region_segment(ocid: str) -> str:
+    # Fourth dot-separated segment of an OCID, without splitting the whole string.
+    # Returns '' when there are fewer than four segments.
+    start = 0
+    for _ in range(3):
+        i = ocid.find('.', start)
+        if i == -1:
+            return ''
+        start = i + 1
+    end = ocid.find('.', start)
+    return ocid[start:] if end == -1 else ocid[start:end]
 
 def normalize_region(region: str) -> str:
-    if REGION_PATTERN.match(region):
+    if is_region_name(region):
         return region
-    return REGION_MAPPING.get(region)
+    # Short region keys that appear in OCIDs
+    if region == 'iad':
+        return 'us-ashburn-1'
+    if region == 'phx':
+        return 'us-phoenix-1'
+    return None
+
+
+def build_region_config(region: str) -> dict:
+    # In-memory client config; authentication is carried by the signer.
+    return {
+        "region": region,
+        "log_requests": False,
+        "additional_user_agent": "",
+        "pass_phrase": None,
+        "user": None,
+        "fingerprint": None,
+        "tenancy": None,
+        "key_file": None,
+    }
+
+
+# === OCI Clients === #
+def _get_signer():
+    global _SIGNER
+    _SIGNER = _SIGNER or oci.auth.signers.InstancePrincipalsSecurityTokenSigner()
+    return _SIGNER
+
+
+def _share_session(client):
+    # Every client reuses the first client's session and its connection pools
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = client.base_client.session
+    else:
+        client.base_client.session = _SESSION
+    return client
 
 
-def prepare_region_file(region: str, base_dir: Path, ocid: str) -> Path:
-    region_file = base_dir / f"{ocid}.{time.strftime('%Y%m%d%H%M%S')}"
-    region_file.write_text(f"[REGION]\nregion = {region}\n")
-    return region_file
+def _get_dr_client(region: str):
+    client = _DR_CLIENTS.get(region)
+    if client is None:
+        client = _share_session(oci.disaster_recovery.DisasterRecoveryClient(
+            config=build_region_config(region), signer=_get_signer()
+        ))
+        _DR_CLIENTS[region] = client
+    return client
 
 
 # === OCI Interactions === #
@@ -118,33 +224,56 @@ def list_active_dr_plans(drpg_ocid, client, logger):
 
     try:
         all_dr_plans = client.list_dr_plans(drpg_ocid)
+        active_plans = []
         for plan in all_dr_plans.data.items:
             if plan.lifecycle_state in transitional_states:
                 logger.error(f"Found transitional state for plan: {plan.display_name} in state {plan.lifecycle_state}")
-                return plan.lifecycle_state
+                return PlansResult("TRANSITIONAL", plan.lifecycle_state)
+            if plan.lifecycle_state == "ACTIVE":
+                active_plans.append(plan)
 
-        # No transitional plans found, fetch ACTIVE ones
-        active_plans = client.list_dr_plans(drpg_ocid, lifecycle_state="ACTIVE")
-        logger.info(f"Found {len(active_plans.data.items)} active DR plans.")
-        return active_plans.data.items  # Return list of active plans
+        # No transitional plans found, keep the ACTIVE ones from the same listing
+        logger.info(f"Found {len(active_plans)} active DR plans.")
+        return PlansResult("ACTIVE", active_plans)
 
     except Exception as e:
         logger.error(f"Failed to list DR plans: {str(e)}", exc_info=True)
-        return None
-
-def send_notification(signer, drpg_name, drpg_ocid, topic_ocid, log, base_dir: Path, logger):
+        return PlansResult("ERROR", None)
+
+def _poll_execution(client, exec_id, logger, terminal=EXECUTION_TERMINAL_STATES,
+                    max_wait_seconds=EXECUTION_MAX_WAIT_SECONDS):
+    # Returns the execution once it is terminal, or None if max_wait_seconds runs out
+    deadline = time.monotonic() + max_wait_seconds
+    attempt = 0
+    while True:
+        execution = client.get_dr_plan_execution(exec_id)
+        state = execution.data.lifecycle_state
+        if state in terminal:
+            return execution
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.debug(f"Execution {exec_id} still {state} after {max_wait_seconds}s")
+            return None
+        delay = min(30, 2 * 1.5 ** attempt, remaining)
+        logger.debug(f"Execution {exec_id} is {state}, checking again in {delay:.0f}s")
+        time.sleep(delay)
+        attempt += 1
+
+def send_notification(signer, drpg_name, drpg_ocid, topic_ocid, log, listener, logger):
     try:
-        content = f"{drpg_name}: {drpg_ocid}\n\n" + log.read_text()
-        topic_region_code = topic_ocid.split('.')[3]
+        flush_log_files(listener)
+        buf = bytearray(f"{drpg_name}: {drpg_ocid}\n\n".encode())
+        buf.extend(log.read_bytes())
+        content = buf.decode("utf-8", errors="replace")
+        topic_region_code = region_segment(topic_ocid)
         region = normalize_region(topic_region_code)
 
         if not region:
             logger.error("Unable to determine valid region for the topic.")
             sys.exit(1)
 
-        region_file = prepare_region_file(region, base_dir, topic_ocid)
-        config = oci.config.from_file(str(region_file), profile_name="REGION")
-        client = oci.ons.NotificationDataPlaneClient(config=config, signer=signer)
+        config = build_region_config(region)
+        client = _share_session(oci.ons.NotificationDataPlaneClient(config=config, signer=signer))
 
         subject = f"FSDR Precheck Results for {drpg_name} - {drpg_ocid}"
 
@@ -156,145 +285,143 @@ def send_notification(signer, drpg_name, drpg_ocid, topic_ocid, log, base_dir: P
             )
         )
 
-        region_file.unlink()
-
     except Exception as e:
         logger.error(f"Failed to send notification: {str(e)}", exc_info=True)
 
 
 # === Main Logic === #
+def _run_one_plan(plan, dr_client, logger) -> bool:
+    options = _OPTIONS_SINGLETONS.get(plan.type)
+    if options is None:
+        logger.error(f"Unknown plan type: {plan.type}")
+        return False
+    logger.info(f"Running precheck for {plan.type} plan: {plan.display_name}")
+
+    try:
+        execution = dr_client.create_dr_plan_execution(
+            oci.disaster_recovery.models.CreateDrPlanExecutionDetails(
+                plan_id=plan.id,
+                execution_options=options
+            )
+        )
+
+        final_status = _poll_execution(dr_client, execution.data.id, logger)
+    except Exception as e:
+        # Plans are independent; one failing call must not discard the others' results
+        logger.error(f"Precheck error for {plan.display_name}: {str(e)}", exc_info=True)
+        return False
+
+    if final_status is None:
+        logger.error(f"Precheck timed out after {EXECUTION_MAX_WAIT_SECONDS}s: {plan.display_name}")
+        return False
+
+    if final_status.data.lifecycle_state == "SUCCEEDED":
+        logger.info(f"Precheck passed: {plan.display_name}")
+        return True
+    logger.error(f"Precheck failed: {plan.display_name}")
+    return False
+
+
 def run_prechecks(drpg_ocid: str, topic_ocid: str, base_dir: Path):
-    logger, notification_log = setup_logger(drpg_ocid, base_dir)
-
-    signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner()
-
-    if not is_valid_ocid(drpg_ocid, DRPG_OCID_PATTERN):
-        logger.error(f"Invalid DRPG OCID format: {drpg_ocid}")
-        if topic_ocid:
-            send_notification(signer, "", drpg_ocid, topic_ocid, notification_log, base_dir, logger)
-        sys.exit(1)
-
-    if topic_ocid and not is_valid_ocid(topic_ocid, TOPIC_OCID_PATTERN):
-        logger.error(f"Invalid Notification Topic OCID format: {topic_ocid}")
-        if topic_ocid:
-            send_notification(signer, "", drpg_ocid, topic_ocid, notification_log, base_dir, logger)
-        sys.exit(1)
-
-    region = normalize_region(drpg_ocid.split('.')[3])
-    if not region:
-        logger.error("Unable to determine region for DRPG.")
-        if topic_ocid:
-            send_notification(signer, "", drpg_ocid, topic_ocid, notification_log, base_dir, logger)
-        sys.exit(1)
-
-    region_file = prepare_region_file(region, base_dir, drpg_ocid)
-    config = oci.config.from_file(str(region_file), profile_name="REGION")
-    dr_client = oci.disaster_recovery.DisasterRecoveryClient(config=config, signer=signer)
-
-    drpg = get_drpg_details(drpg_ocid, dr_client, logger)
-    if not drpg:
-        region_file.unlink()
-        if topic_ocid:
-            send_notification(signer, "", drpg_ocid, topic_ocid, notification_log, base_dir, logger)
-        sys.exit(1)
-
-    role = drpg.data.role
-    peer_ocid = drpg.data.peer_id
-    peer_region = drpg.data.peer_region
-
-    if role == "UNCONFIGURED":
-        logger.error("DRPG is unconfigured.")
-        region_file.unlink()
-        if topic_ocid:
-            send_notification(signer, drpg.data.display_name, drpg_ocid, topic_ocid, notification_log, base_dir, logger)
-        sys.exit(1)
-
-    if role == "PRIMARY":
-        logger.warning("DRPG is PRIMARY, switching to PEER.")
-        region_file.unlink()
-        region = normalize_region(peer_region)
+    timestamp = time.strftime("%Y%m%d%H%M%S")
+    logger, notification_log, listener = setup_logger(drpg_ocid, base_dir, timestamp)
+
+    try:
+        signer = _get_signer()
+
+        if not is_valid_ocid(drpg_ocid, DRPG_OCID_TYPE):
+            logger.error(f"Invalid DRPG OCID format: {drpg_ocid}")
+            if topic_ocid:
+                send_notification(signer, "", drpg_ocid, topic_ocid, notification_log, listener, logger)
+            sys.exit(1)
+
+        if topic_ocid and not is_valid_ocid(topic_ocid, TOPIC_OCID_TYPE):
+            logger.error(f"Invalid Notification Topic OCID format: {topic_ocid}")
+            if topic_ocid:
+                send_notification(signer, "", drpg_ocid, topic_ocid, notification_log, listener, logger)
+            sys.exit(1)
+
+        region = normalize_region(region_segment(drpg_ocid))
         if not region:
-            logger.error("Unknown peer region.")
-            region_file.unlink()
+            logger.error("Unable to determine region for DRPG.")
+            if topic_ocid:
+                send_notification(signer, "", drpg_ocid, topic_ocid, notification_log, listener, logger)
             sys.exit(1)
-        region_file = prepare_region_file(region, base_dir, peer_ocid)
-        config = oci.config.from_file(str(region_file), profile_name="REGION")
-        dr_client = oci.disaster_recovery.DisasterRecoveryClient(config=config, signer=signer)
-        drpg = get_drpg_details(peer_ocid, dr_client, logger)
+
+        dr_client = _get_dr_client(region)
+
+        drpg = get_drpg_details(drpg_ocid, dr_client, logger)
         if not drpg:
-            logger.error("Failed to get peer DRPG details.")
-            region_file.unlink()
             if topic_ocid:
-                send_notification(signer, "", peer_ocid, topic_ocid, notification_log, base_dir, logger)
+                send_notification(signer, "", drpg_ocid, topic_ocid, notification_log, listener, logger)
+            sys.exit(1)
+
+        role = drpg.data.role
+        peer_ocid = drpg.data.peer_id
+        peer_region = drpg.data.peer_region
+
+        if role == "UNCONFIGURED":
+            logger.error("DRPG is unconfigured.")
+            if topic_ocid:
+                send_notification(signer, drpg.data.display_name, drpg_ocid, topic_ocid, notification_log, listener, logger)
             sys.exit(1)
 
-    standby_ocid = drpg.data.id
-    standby_name = drpg.data.display_name
-    standby_state = drpg.data.lifecycle_state
-
-    logger.info(f"Standby DRPG: {standby_name} ({standby_ocid}) is {standby_state}")
-
-    if standby_state not in ("ACTIVE", "INACTIVE"):
-        logger.error(f"Standby DRPG is {standby_state}.")
-        region_file.unlink()
-        if topic_ocid:
-            send_notification(signer, standby_name, standby_ocid, topic_ocid, notification_log, base_dir, logger)
-        sys.exit(1)
-
-    dr_plans = list_active_dr_plans(standby_ocid, dr_client, logger)
-
-    if len(dr_plans) == 0:
-        logger.error(f"No Active DR plans found in {standby_name}.")
-        region_file.unlink()
-        if topic_ocid:
-            send_notification(signer, standby_name, standby_ocid, topic_ocid, notification_log, base_dir, logger)
-        sys.exit(1)
-    
-    if isinstance(dr_plans, str):
-        region_file.unlink()
-        if topic_ocid:
-            send_notification(signer, standby_name, standby_ocid, topic_ocid, notification_log, base_dir, logger)
-        sys.exit(1)
-    elif isinstance(dr_plans, list):
-        for plan in dr_plans:
-            plan_type = DrPlanType(plan.type)
-            logger.info(f"Running precheck for {plan_type.value} plan: {plan.display_name}")
-
-            if plan_type == DrPlanType.SWITCHOVER:
-                options = oci.disaster_recovery.models.SwitchoverPrecheckExecutionOptionDetails()
-            elif plan_type == DrPlanType.FAILOVER:
-                options = oci.disaster_recovery.models.FailoverPrecheckExecutionOptionDetails()
-            elif plan_type == DrPlanType.START_DRILL:
-                options = oci.disaster_recovery.models.StartDrillPrecheckExecutionOptionDetails()
-            elif plan_type == DrPlanType.STOP_DRILL:
-                options = oci.disaster_recovery.models.StopDrillPrecheckExecutionOptionDetails()
-            else:
-                logger.error(f"Unknown plan type: {plan.type}")
+        if role == "PRIMARY":
+            logger.warning("DRPG is PRIMARY, switching to PEER.")
+            region = normalize_region(peer_region)
+            if not region:
+                logger.error("Unknown peer region.")
+                sys.exit(1)
+            dr_client = _get_dr_client(region)
+            drpg = get_drpg_details(peer_ocid, dr_client, logger)
+            if not drpg:
+                logger.error("Failed to get peer DRPG details.")
+                if topic_ocid:
+                    send_notification(signer, "", peer_ocid, topic_ocid, notification_log, listener, logger)
                 sys.exit(1)
 
-            execution = dr_client.create_dr_plan_execution(
-                oci.disaster_recovery.models.CreateDrPlanExecutionDetails(
-                    plan_id=plan.id,
-                    execution_options=options
-                )
-            )
+        standby_ocid = drpg.data.id
+        standby_name = drpg.data.display_name
+        standby_state = drpg.data.lifecycle_state
+
+        logger.info(f"Standby DRPG: {standby_name} ({standby_ocid}) is {standby_state}")
 
-            oci.wait_until(dr_client, dr_client.get_dr_plan_execution(execution.data.id), 'lifecycle_state', 'IN_PROGRESS')
-            oci.wait_until(dr_client, get_drpg_details(standby_ocid, dr_client, logger), 'lifecycle_state', standby_state)
-            final_status = dr_client.get_dr_plan_execution(execution.data.id)
+        if standby_state not in ("ACTIVE", "INACTIVE"):
+            logger.error(f"Standby DRPG is {standby_state}.")
+            if topic_ocid:
+                send_notification(signer, standby_name, standby_ocid, topic_ocid, notification_log, listener, logger)
+            sys.exit(1)
 
-            if final_status.data.lifecycle_state == "SUCCEEDED":
-                logger.info(f"Precheck passed: {plan.display_name}")
-            else:
-                logger.error(f"Precheck failed: {plan.display_name}")
+        plans = list_active_dr_plans(standby_ocid, dr_client, logger)
 
-        if notification_log.exists() and notification_log.stat().st_size > 0 and topic_ocid:
-            send_notification(signer, standby_name, standby_ocid, topic_ocid, notification_log, base_dir, logger)
+        # TRANSITIONAL and ERROR results were already logged by list_active_dr_plans
+        if plans.kind == "ACTIVE" and not plans.value:
+            logger.error(f"No Active DR plans found in {standby_name}.")
+
+        if plans.kind != "ACTIVE" or not plans.value:
+            if topic_ocid:
+                send_notification(signer, standby_name, standby_ocid, topic_ocid, notification_log, listener, logger)
+            sys.exit(1)
 
-        if region_file.exists():
-            region_file.unlink()
-        if notification_log.exists():
+        dr_plans = plans.value
+        # A protection group runs one plan execution at a time, so prechecks stay serial
+        results = [_run_one_plan(plan, dr_client, logger) for plan in dr_plans]
+        logger.info(f"{sum(results)} of {len(results)} prechecks passed.")
+
+        flush_log_files(listener)
+        if notification_log.exists() and notification_log.stat().st_size > 0 and topic_ocid:
+            send_notification(signer, standby_name, standby_ocid, topic_ocid, notification_log, listener, logger)
+    finally:
+        # stop() already drains the queue; joining it afterwards hangs on Python 3.6,
+        # whose listener does not mark the stop sentinel as done. Closing flushes the
+        # buffered files and releases the notification log before it is unlinked.
+        listener.stop()
+        for h in listener.handlers:
+            h.close()
+        try:
             notification_log.unlink()
+        except FileNotFoundError:
+            pass
 
 # === Entry Point === #
 if __name__ == "__main__":